@@ -1,17 +1,20 @@
 """Prototype."""
 
 
+import dataclasses
 import datetime as dt
-import json
+import os
 import shutil
+import sys
+import threading
 from dataclasses import dataclass
-from os import makedirs, path
+from os import link, makedirs, path
 from os import unlink as delete
 from pathlib import Path
-from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional, Tuple, Union
 
 import yaml
-from dataclasses_json import dataclass_json
+from dataclasses_json import DataClassJsonMixin
 from structlog import get_logger
 
 from . import files, owid_cache
@@ -28,12 +31,56 @@ INDEX_DIR = path.abspath(path.join(BASE_DIR, "index"))
 # the JSONschema that they must match
 SCHEMA_FILE = path.join(BASE_DIR, "schema.json")
 
+# consolidated copy of every parsed document, kept in the index folder
+SNAPSHOT_FILE = ".snapshot"
+
 log = get_logger()
 
 
-@dataclass_json
+def _compile_dict_methods(cls):
+    """
+    Give a dataclass `from_dict` and `to_dict` methods generated for its exact fields, so that
+    converting a record does no per-field looping or type dispatch at runtime. Unknown keys are
+    ignored. All fields must hold plain values, with plain defaults if they are optional.
+    """
+    fields = dataclasses.fields(cls)
+    for f in fields:
+        if f.default_factory is not dataclasses.MISSING:
+            raise TypeError(f"field {f.name} of {cls.__name__} uses default_factory, which isn't supported")
+
+    namespace: Dict[str, Any] = {"DataClassJsonMixin": DataClassJsonMixin}
+    args = []
+    for f in fields:
+        if f.default is dataclasses.MISSING:
+            args.append(f"{f.name}=kvs[{f.name!r}]")
+        else:
+            namespace[f"_default_{f.name}"] = f.default
+            args.append(f"{f.name}=get({f.name!r}, _default_{f.name})")
+
+    items = ", ".join(f"{f.name!r}: self.{f.name}" for f in fields)
+    source = f"""
+def from_dict(cls, kvs, *, infer_missing=False):
+    if infer_missing:
+        # only the generic decoder knows how to fill in missing fields
+        return DataClassJsonMixin.from_dict.__func__(cls, kvs, infer_missing=True)
+    get = kvs.get
+    return cls({", ".join(args)})
+
+def to_dict(self, encode_json=False):
+    if encode_json:
+        return DataClassJsonMixin.to_dict(self, encode_json=True)
+    return {{{items}}}
+"""
+    exec(source, namespace)
+
+    cls.from_dict = classmethod(namespace["from_dict"])
+    cls.to_dict = namespace["to_dict"]
+    return cls
+
+
+@_compile_dict_methods
 @dataclass
-class Dataset:
+class Dataset(DataClassJsonMixin):
     """
     A specific dataset represented by a data file plus metadata.
     If there are multiple versions, this is just one of them.
@@ -102,28 +149,35 @@ class Dataset:
             # version can be loaded as datetime.date, but it has to be string
             self.version = str(self.version)
 
+        # these repeat across thousands of datasets, so share a single copy of each value
+        self.version = sys.intern(self.version)
+        for name in ("namespace", "short_name", "file_extension", "source_name"):
+            value = getattr(self, name)
+            if type(value) is str:
+                setattr(self, name, sys.intern(value))
+
     @classmethod
     def download_and_create(cls, metadata: Union[dict, "Dataset"]) -> "Dataset":
         if isinstance(metadata, dict):
-            dataset = Dataset.from_dict(metadata)  # type: ignore
+            dataset = Dataset.from_dict(metadata)
         else:
             dataset = metadata
 
         # make sure we have a local copy
-        filename = dataset.ensure_downloaded()
+        filename, md5 = dataset._ensure_downloaded()
 
-        # set the md5
-        dataset.md5 = files.checksum(filename)
+        # set the md5, reusing the one computed while downloading if we have it
+        dataset.md5 = md5 or files.checksum(filename)
 
         return dataset
 
     @classmethod
-    def copy_and_create(cls, filename: str, metadata: Union[dict, "Dataset"]) -> "Dataset":
+    def copy_and_create(cls, filename: str, metadata: Union[dict, "Dataset"], hardlink: bool = False) -> "Dataset":
         """
-        Create a new dataset if you already have the file locally.
+        Create a new dataset if you already have the file locally. See `add_to_cache` for `hardlink`.
         """
         if isinstance(metadata, dict):
-            dataset = Dataset.from_dict(metadata)  # type: ignore
+            dataset = Dataset.from_dict(metadata)
         else:
             dataset = metadata
 
@@ -131,14 +185,14 @@ class Dataset:
         dataset.md5 = files.checksum(filename)
 
         # copy the file into the cache
-        dataset.add_to_cache(filename)
+        dataset.add_to_cache(filename, hardlink=hardlink)
 
         return dataset
 
     @classmethod
     def from_file(cls, filename: str) -> "Dataset":
         with open(filename) as istream:
-            return cls.from_json(istream.read())  # type: ignore
+            return cls.from_json(istream.read())
 
     @classmethod
     def from_yaml(cls, filename: Union[str, Path]) -> "Dataset":
@@ -146,16 +200,36 @@ class Dataset:
             meta = yaml.safe_load(istream)
             return cls(**meta)
 
-    def add_to_cache(self, filename: str) -> None:
+    def add_to_cache(self, filename: str, hardlink: bool = False) -> None:
         """
         Copy the pre-downloaded file into the cache. This avoids having to
         redownload it if you already have a copy.
+
+        With `hardlink=True` the cache shares the file's storage instead, which is instant no matter
+        how big the file is. Only use it for files nobody will modify afterwards (e.g. temporary
+        files), since any change to them would silently change the cached copy too.
         """
         cache_file = self.local_path
 
         # make the parent folder
         create(cache_file)
-        shutil.copy(filename, cache_file)
+
+        if path.exists(cache_file):
+            if path.samefile(filename, cache_file):
+                return
+
+            # never write through an old cache file, it may be linked to some other file
+            delete(cache_file)
+
+        if hardlink:
+            try:
+                link(filename, cache_file)
+                return
+            except OSError:
+                # e.g. the cache is on a different filesystem, so make a real copy
+                pass
+
+        shutil.copyfile(filename, cache_file)
 
     @property
     def metadata(self) -> Dict[str, Any]:
@@ -165,8 +239,7 @@ class Dataset:
     def save(self) -> None:
         "Save any changes as JSON to the catalog."
         create(self.index_path)
-        with open(self.index_path, "w") as ostream:
-            print(json.dumps(self.metadata, indent=2, default=str), file=ostream)  # type: ignore
+        files.write_json(self.metadata, self.index_path)
 
     def delete(self) -> None:
         """
@@ -178,19 +251,43 @@ class Dataset:
 
     @property
     def index_path(self) -> str:
-        return path.join(INDEX_DIR, f"{self.relative_base}.json")
+        return self._paths()[2]
 
     @property
-    def relative_base(self):
-        assert self.version
-        return path.join(self.namespace, self.version, f"{self.short_name}")
+    def relative_base(self) -> str:
+        return self._paths()[1]
 
-    def ensure_downloaded(self, quiet=False) -> str:
+    def _paths(self) -> Tuple[tuple, str, str, str]:
+        """
+        Return the key the paths were built from, plus `relative_base`, `index_path` and `local_path`.
+        They are computed once and reused until one of the fields they depend on is changed.
+        """
+        key = (self.namespace, self.version, self.short_name, self.file_extension, INDEX_DIR, CACHE_DIR)
+        cached = self.__dict__.get("_cached_paths")
+        if cached is None or cached[0] != key:
+            assert self.version
+            relative_base = path.join(self.namespace, self.version, f"{self.short_name}")
+            cached = (
+                key,
+                relative_base,
+                path.join(INDEX_DIR, f"{relative_base}.json"),
+                path.join(CACHE_DIR, f"{relative_base}.{self.file_extension}"),
+            )
+            self.__dict__["_cached_paths"] = cached
+
+        return cached
+
+    def ensure_downloaded(self, quiet=False, show_progress=True) -> str:
         "Download it if it hasn't already been downloaded and matches checksum. Return the local file path."
+        filename, _ = self._ensure_downloaded(quiet=quiet, show_progress=show_progress)
+        return filename
+
+    def _ensure_downloaded(self, quiet=False, show_progress=True) -> Tuple[str, Optional[str]]:
+        "Like `ensure_downloaded`, but also return the md5 of the file if it was computed along the way."
         filename = self.local_path
 
         if self.md5 and path.exists(filename) and files.checksum(filename) == self.md5:
-            return filename
+            return filename, self.md5
         else:
             # make the parent folder
             create(filename)
@@ -200,11 +297,19 @@ class Dataset:
             if not url:
                 raise Exception(f"dataset {self.name} has neither source_data_url nor owid_data_url")
             if self.is_public:
-                files.download(url, filename, expected_md5=self.md5, quiet=quiet)
+                md5 = files.download(url, filename, expected_md5=self.md5, quiet=quiet, show_progress=show_progress)
             else:
-                owid_cache.download(url, filename, expected_md5=self.md5, quiet=quiet)
+                md5 = owid_cache.download(url, filename, expected_md5=self.md5, quiet=quiet)
 
-        return filename
+        return filename, md5
+
+    @classmethod
+    def ensure_downloaded_many(cls, datasets: Iterable["Dataset"], quiet=False) -> List[str]:
+        """
+        Make sure all the datasets are downloaded, fetching several of them concurrently like
+        `files.download_many`. Return their local file paths.
+        """
+        return files.map_downloads(lambda d: d.ensure_downloaded(quiet=quiet, show_progress=False), datasets)
 
     def upload(self, public: bool = False, check_changed: bool = False) -> bool:
         """Copy the local file to our cache. It updates the `owid_data_url` field.
@@ -271,10 +376,7 @@ class Dataset:
 
     @property
     def local_path(self) -> str:
-        return path.join(CACHE_DIR, f"{self.relative_base}.{self.file_extension}")
-
-    def to_dict(self) -> Dict[str, Any]:
-        ...
+        return self._paths()[3]
 
     def has_changed_from_last_version(self) -> bool:
         """Check if local dataset is different to latest available version in Walden.
@@ -320,7 +422,13 @@ class Catalog:
         self.refresh()
 
     def refresh(self):
-        self.datasets = [Dataset.from_dict(d) for _, d in iter_docs()]  # type: ignore
+        self.datasets = [Dataset.from_dict(d) for _, d in iter_docs()]
+
+    @staticmethod
+    def build_snapshot() -> None:
+        "Parse every document in the index and save them all to the snapshot, ready for the next load."
+        filenames = sorted(files.iter_json(INDEX_DIR))
+        _write_snapshot(_snapshot_signature(filenames), files.load_docs(filenames))
 
     def __iter__(self):
         yield from iter(self.datasets)
@@ -373,12 +481,58 @@ class Catalog:
 
 
 def load_schema() -> dict:
-    with open(SCHEMA_FILE) as istream:
-        return json.load(istream)
+    return files.load_json(SCHEMA_FILE)
 
 
 def iter_docs() -> Iterator[Tuple[str, dict]]:
-    return files.iter_docs(INDEX_DIR)
+    """Iterate over the documents in the index, sorted by filename. If the snapshot is up to date they
+    come from it, otherwise every file is parsed and the snapshot is rebuilt."""
+    filenames = sorted(files.iter_json(INDEX_DIR))
+    signature = _snapshot_signature(filenames)
+
+    docs = _read_snapshot(signature)
+    if docs is None:
+        docs = files.load_docs(filenames)
+        _write_snapshot(signature, docs)
+
+    yield from docs
+
+
+def _snapshot_signature(filenames: List[str]) -> List[Tuple[str, int, int]]:
+    "Identify the state of the files cheaply, so that we know when the snapshot is stale."
+    signature = []
+    for filename in filenames:
+        st = os.stat(filename)
+        signature.append((filename, st.st_mtime_ns, st.st_size))
+
+    return signature
+
+
+def _read_snapshot(signature: List[Tuple[str, int, int]]) -> Optional[List[Tuple[str, dict]]]:
+    try:
+        snapshot = files.load_json(path.join(INDEX_DIR, SNAPSHOT_FILE))
+        if [tuple(s) for s in snapshot["signature"]] != signature:
+            return None
+
+        return [(filename, doc) for filename, doc in snapshot["docs"]]
+
+    except (OSError, ValueError, KeyError, TypeError):
+        # missing, unreadable or written by an incompatible version, just rebuild it
+        return None
+
+
+def _write_snapshot(signature: List[Tuple[str, int, int]], docs: List[Tuple[str, dict]]) -> None:
+    # write then rename, so that concurrent readers never see a partial snapshot; open() rather
+    # than a NamedTemporaryFile gives the file normal permissions, so the snapshot can be shared
+    snapshot_file = path.join(INDEX_DIR, SNAPSHOT_FILE)
+    tmp_filename = f"{snapshot_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        files.write_json({"signature": signature, "docs": docs}, tmp_filename, compact=True)
+        os.replace(tmp_filename, snapshot_file)
+    except OSError:
+        # the index may be read-only, e.g. when installed as a package
+        if path.exists(tmp_filename):
+            os.remove(tmp_filename)
 
 
 def create(filename) -> None:
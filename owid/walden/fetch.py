@@ -9,7 +9,7 @@ from os import path
 
 import click
 
-from owid.walden import Catalog, ui
+from owid.walden import Catalog, Dataset, ui
 
 
 @click.command()
@@ -18,12 +18,15 @@ def fetch():
     Fetch the full dataset file by file. Previously downloaded files are considered
     cached and are not re-downloaded.
     """
+    missing = []
     for dataset in Catalog():
         if path.exists(dataset.local_path):
             ui.log("CACHED", dataset.local_path)
 
         else:
-            dataset.ensure_downloaded()
+            missing.append(dataset)
+
+    Dataset.ensure_downloaded_many(missing)
 
 
 if __name__ == "__main__":
@@ -4,14 +4,34 @@
 #  Helpers for downloading and dealing with files.
 #
 
+import concurrent.futures
 import hashlib
 import json
+import mmap
 import os
-import shutil
-from os import path, walk
-from typing import IO, Iterator, Optional, Tuple
+import threading
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 from rich.progress import (
     BarColumn,
     DownloadColumn,
@@ -22,8 +42,62 @@ from rich.progress import (
 
 from .ui import log
 
+# smallest chunk we'll read from the network while downloading, in bytes
+MIN_DOWNLOAD_CHUNK_SIZE = 2**16
+
+
+# size of each chunk read from the network while downloading, in bytes, unless WALDEN_DL_CHUNK says otherwise
+DOWNLOAD_CHUNK_SIZE = 2**18
+
+
+def _download_chunk_size() -> int:
+    """Read the download chunk size from WALDEN_DL_CHUNK, defaulting to 256KB and never going below 64KB.
+    Checked on each download rather than at import, so that a bad value doesn't stop walden loading."""
+    value = os.environ.get("WALDEN_DL_CHUNK")
+    if value is None:
+        return DOWNLOAD_CHUNK_SIZE
+
+    try:
+        chunk_size = int(value)
+    except ValueError:
+        raise ValueError(f"WALDEN_DL_CHUNK must be a number of bytes, got {value!r}")
+
+    if chunk_size <= 0:
+        raise ValueError(f"WALDEN_DL_CHUNK must be positive, got {chunk_size}")
+
+    return max(chunk_size, MIN_DOWNLOAD_CHUNK_SIZE)
+
 
-def _create_progress_bar() -> Progress:
+# files bigger than this are fetched over several connections at once, if the server allows it
+RANGED_DOWNLOAD_MIN_BYTES = 2**26
+RANGED_DOWNLOAD_CONNECTIONS = 8
+
+# how many files are downloaded at once when fetching several of them
+DOWNLOAD_WORKERS = 4
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def _create_session() -> requests.Session:
+    "Create an HTTP session that keeps connections alive between downloads and retries transient errors."
+    session = requests.Session()
+    # once retries run out, hand back the last error response so that raise_for_status() raises
+    # the usual HTTPError, rather than urllib3 raising a RetryError
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    # enough connections per host for every concurrent download to fetch all its ranges at once
+    pool_maxsize = DOWNLOAD_WORKERS * RANGED_DOWNLOAD_CONNECTIONS
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# shared by all downloads, so that connections and TLS sessions get reused
+_SESSION = _create_session()
+
+
+def _create_progress_bar(disable: bool = False) -> Progress:
     """Create a fancy progress bar to use for display of download progress.
     Based on https://github.com/Textualize/rich/blob/ae1ee4efa1742e7a91ffd4870ba677aad70ff036/examples/downloader.py"""
     return Progress(
@@ -36,31 +110,41 @@ def _create_progress_bar() -> Progress:
         TransferSpeedColumn(),
         "•",
         TimeElapsedColumn(),
+        disable=disable,
     )
 
 
 def _stream_to_file(
     r: requests.Response,
     file: IO[bytes],
-    chunk_size: int = 2**14,
+    chunk_size: Optional[int] = None,
     progress_bar_min_bytes: int = 2**25,
+    show_progress: bool = True,
 ) -> str:
     """Stream the response to the file, returning the checksum.
+    :param chunk_size: Number of bytes to read per chunk. Default is 256KB, override with WALDEN_DL_CHUNK
     :param progress_bar_min_bytes: Minimum number of bytes to display a progress bar for. Default is 32MB
+    :param show_progress: Set to False to never display a progress bar
     """
+    chunk_size = chunk_size or _download_chunk_size()
+
     # check header to get content length, in bytes
     total_length = int(r.headers.get("content-length", 0))
 
     md5 = hashlib.md5()
 
     streamer = r.iter_content(chunk_size=chunk_size)
-    display_progress = total_length > progress_bar_min_bytes
+
+    # the length of an encoded body says nothing about the size of the decoded file
+    preallocated = total_length > 0 and "content-encoding" not in r.headers and _preallocate(file, total_length)
+
+    display_progress = show_progress and total_length > progress_bar_min_bytes
     if display_progress:
         progress = _create_progress_bar()
         progress.start()
         task_id = progress.add_task("Downloading", total=total_length)
 
-    for chunk in streamer:  # 16k
+    for chunk in streamer:
         file.write(chunk)
         md5.update(chunk)
         if display_progress:
@@ -69,62 +153,335 @@ def _stream_to_file(
     if display_progress:
         progress.stop()  # type: ignore
 
+    if preallocated:
+        # don't leave reserved space at the end if the server sent less than it announced
+        file.truncate()
+
     return md5.hexdigest()
 
 
-def download(url: str, filename: str, expected_md5: Optional[str] = None, quiet: bool = False) -> None:
-    "Download the file at the URL to the given local filename."
-    # NOTE: we are not streaming to a NamedTemporaryFile because it was causing weird
-    # issues one some systems, it's safer to stream directly to the file and remove it
-    # if md5 don't match
-    tmp_filename = filename + ".tmp"
-    with open(tmp_filename, "wb") as f, requests.get(url, stream=True) as r:
-        r.raise_for_status()
+def _preallocate(file: IO[bytes], length: int) -> bool:
+    """Reserve the disk space for the whole file upfront, so the filesystem doesn't have to keep
+    extending it, and hint the kernel that it will be written sequentially. Return whether it worked."""
+    try:
+        os.posix_fallocate(file.fileno(), 0, length)
+    except (AttributeError, OSError):
+        # not available on every platform or filesystem
+        return False
+
+    try:
+        os.posix_fadvise(file.fileno(), 0, length, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+    return True
 
-        md5 = _stream_to_file(r, f)
 
-        if expected_md5 and md5 != expected_md5:
-            if os.path.exists(filename):
-                os.remove(filename)
-            raise ChecksumDoesNotMatch(
-                f"for file downloaded from {url}. Is your walden repository up to date?\n\twalden index checksum = {expected_md5}\n\tdownloaded checksum = {md5}"
-                ""
-            )
+def _supports_ranges(r: requests.Response) -> bool:
+    # byte ranges of an encoded body don't line up with the decoded file, so avoid them
+    return r.headers.get("accept-ranges") == "bytes" and "content-encoding" not in r.headers and hasattr(os, "pwrite")
 
-    shutil.move(tmp_filename, filename)
+
+def _range_validator(r: requests.Response) -> Optional[str]:
+    "Return a strong ETag or Last-Modified date to send as If-Range, if the response has one."
+    etag = r.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return r.headers.get("last-modified")
+
+
+def _download_ranges(
+    url: str,
+    file: IO[bytes],
+    total_length: int,
+    validator: str,
+    connections: int = RANGED_DOWNLOAD_CONNECTIONS,
+    chunk_size: Optional[int] = None,
+    show_progress: bool = True,
+) -> None:
+    """Download the file as disjoint byte ranges over several connections, writing each range
+    straight to its offset in the file. Helps on links where a single TCP stream can't fill the pipe.
+
+    Every range is requested with `If-Range: validator`, so if the file changes on the server meanwhile
+    we get a full response instead of a range, and raise RangeRequestFailed rather than mix versions."""
+    chunk_size = chunk_size or _download_chunk_size()
+    fd = file.fileno()
+    if not _preallocate(file, total_length):
+        file.truncate(total_length)
+
+    part_size = -(-total_length // connections)
+    ranges = [(lo, min(lo + part_size, total_length) - 1) for lo in range(0, total_length, part_size)]
+
+    progress = _create_progress_bar(disable=not show_progress)
+    progress.start()
+    task_id = progress.add_task("Downloading", total=total_length)
+
+    # set when any range fails or we are interrupted, so that the others give up early
+    stop = threading.Event()
+
+    def fetch(byte_range: Tuple[int, int]) -> None:
+        lo, hi = byte_range
+        headers = {"Range": f"bytes={lo}-{hi}", "If-Range": validator, "Accept-Encoding": "identity"}
+        with _SESSION.get(url, headers=headers, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RangeRequestFailed(f"{url} ignored range request for bytes {lo}-{hi}")
+
+            offset = lo
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if stop.is_set():
+                    return
+
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                progress.update(task_id, advance=len(chunk))
+
+        if offset != hi + 1:
+            raise RangeRequestFailed(f"{url} returned {offset - lo} bytes for range {lo}-{hi}")
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch, byte_range) for byte_range in ranges]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                stop.set()
+                raise
+    finally:
+        progress.stop()
+
+
+def download(
+    url: str, filename: str, expected_md5: Optional[str] = None, quiet: bool = False, show_progress: bool = True
+) -> str:
+    "Download the file at the URL to the given local filename. Return the md5 of the downloaded file."
+    # NOTE: we are not streaming to a NamedTemporaryFile because it was causing weird
+    # issues one some systems. Keeping the temporary file next to the destination also
+    # means it ends up on the same filesystem, so moving it into place is a cheap rename
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "wb") as f, _SESSION.get(url, stream=True) as r:
+            r.raise_for_status()
+
+            total_length = int(r.headers.get("content-length", 0))
+            # without a validator we can't make sure every range comes from the same version of the file
+            validator = _range_validator(r)
+            if total_length > RANGED_DOWNLOAD_MIN_BYTES and validator and _supports_ranges(r):
+                # we only needed the headers, fetch the body in parallel pieces instead
+                r.close()
+                try:
+                    _download_ranges(url, f, total_length, validator, show_progress=show_progress)
+                    md5 = checksum(tmp_filename)
+                except RangeRequestFailed:
+                    # the file changed or the server misbehaved, start over with a plain download
+                    f.seek(0)
+                    f.truncate()
+                    with _SESSION.get(url, stream=True) as r:
+                        r.raise_for_status()
+                        md5 = _stream_to_file(r, f, show_progress=show_progress)
+            else:
+                md5 = _stream_to_file(r, f, show_progress=show_progress)
+
+    except BaseException:
+        # don't leave partial downloads behind
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    if expected_md5 and md5 != expected_md5:
+        os.remove(tmp_filename)
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise ChecksumDoesNotMatch(
+            f"for file downloaded from {url}. Is your walden repository up to date?\n\twalden index checksum = {expected_md5}\n\tdownloaded checksum = {md5}"
+            ""
+        )
+
+    os.replace(tmp_filename, filename)
 
     if not quiet:
         log("DOWNLOADED", f"{url} -> {filename}")
 
+    return md5
 
-def checksum(local_path: str) -> str:
-    md5 = hashlib.md5()
-    chunk_size = 2**20  # 1MB
+
+def _new_hash(algorithm: str) -> Any:
+    """Create a hash object for the given algorithm. Anything known to hashlib works, plus
+    "blake3" if the optional `blake3` package is installed."""
+    if algorithm == "blake3":
+        try:
+            from blake3 import blake3  # type: ignore
+        except ImportError:
+            raise UnsupportedChecksumAlgorithm("blake3 checksums need the `blake3` package installed")
+
+        return blake3(max_threads=blake3.AUTO)
+
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise UnsupportedChecksumAlgorithm(algorithm)
+
+
+def download_many(pairs: Iterable[Tuple[str, str]], quiet: bool = False) -> List[str]:
+    """Download several (url, filename) pairs concurrently, returning their md5s. Progress bars are
+    not shown since they can't be displayed simultaneously."""
+    return map_downloads(lambda pair: download(*pair, quiet=quiet, show_progress=False), pairs)
+
+
+def map_downloads(func: Callable[[T], R], items: Iterable[T]) -> List[R]:
+    """Call a downloading function on every item, running up to DOWNLOAD_WORKERS of them at once so
+    that their request latencies and transfers overlap. Errors in any call are raised here."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        return list(executor.map(func, items))
+
+
+def checksum(local_path: str, algorithm: str = "md5") -> str:
+    """Return the hex digest of the file. MD5 is what the index stores, but faster algorithms
+    such as sha256 (hardware accelerated on most CPUs) or blake3 can be used for local checks."""
+    hasher = _new_hash(algorithm)
     with open(local_path, "rb") as f:
-        chunk = f.read(chunk_size)
-        while chunk:
-            md5.update(chunk)
+        if hasattr(hashlib, "file_digest"):
+            # python 3.11+ reads into a single reused buffer and releases the GIL while hashing
+            return hashlib.file_digest(f, lambda: hasher).hexdigest()  # type: ignore
+
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files can't be mapped, nor can files on some filesystems
+            chunk_size = 2**20  # 1MB
             chunk = f.read(chunk_size)
+            while chunk:
+                hasher.update(chunk)
+                chunk = f.read(chunk_size)
+        else:
+            # hash the whole file in a single call, without a Python read loop or buffer copies
+            with mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mm)
+
+    return hasher.hexdigest()
+
+
+def checksum_many(
+    local_paths: Iterable[str], algorithm: str = "md5", max_workers: Optional[int] = None
+) -> Dict[str, str]:
+    """Checksum many files at once, returning a mapping from path to hex digest. hashlib releases
+    the GIL while hashing, so files are hashed in parallel across cores."""
+    local_paths = list(local_paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = executor.map(lambda p: checksum(p, algorithm=algorithm), local_paths)
+        return dict(zip(local_paths, digests))
+
+
+def load_json(filename: str) -> Any:
+    "Parse a JSON file, using orjson when it is installed."
+    with open(filename, "rb") as istream:
+        contents = istream.read()
+
+    if orjson is not None:
+        return orjson.loads(contents)
+
+    return json.loads(contents)
+
+
+def write_json(obj: Any, filename: str, compact: bool = False) -> None:
+    """Write JSON to the file in the same layout as the index (2 space indent, ASCII only, trailing newline
+    like editors leave), using orjson when it is installed. Unknown types are serialised with `str`. With
+    `compact`, write it on one line in UTF-8 instead, for files that only we read back."""
+    if compact:
+        _write_compact_json(obj, filename)
+        return
+
+    out = _orjson_dumps(obj, newline=True)
+    if out is not None:
+        with open(filename, "wb") as ostream:
+            ostream.write(out)
+        return
+
+    with open(filename, "w") as ostream:
+        json.dump(obj, ostream, indent=2, default=str)
+        ostream.write("\n")
+
+
+def _write_compact_json(obj: Any, filename: str) -> None:
+    if orjson is not None:
+        with open(filename, "wb") as ostream:
+            ostream.write(orjson.dumps(obj, default=str))
+        return
+
+    with open(filename, "w", encoding="utf-8") as ostream:
+        json.dump(obj, ostream, separators=(",", ":"), ensure_ascii=False, default=str)
 
-    return md5.hexdigest()
+
+def _orjson_dumps(obj: Any, newline: bool = False) -> Optional[bytes]:
+    "Serialise with orjson, or return None if it's not installed or can't match the stdlib's output."
+    # orjson writes NaN as null and formats exponents differently (1e16 vs 1e+16)
+    if orjson is None or _contains_float(obj):
+        return None
+
+    option = orjson.OPT_INDENT_2 | orjson.OPT_PASSTHROUGH_DATETIME
+    if newline:
+        option |= orjson.OPT_APPEND_NEWLINE
+
+    try:
+        out = orjson.dumps(obj, default=str, option=option)
+    except orjson.JSONEncodeError:
+        return None
+
+    # orjson always emits UTF-8, but the index escapes non-ASCII characters
+    if not out.isascii():
+        return None
+
+    return out
+
+
+def _contains_float(obj: Any) -> bool:
+    if isinstance(obj, float):
+        return True
+
+    if isinstance(obj, dict):
+        return any(_contains_float(v) for v in obj.values())
+
+    if isinstance(obj, (list, tuple)):
+        return any(_contains_float(v) for v in obj)
+
+    return False
 
 
 def iter_docs(folder) -> Iterator[Tuple[str, dict]]:
-    "Iterate over the JSON documents in the catalog."
-    for filename in sorted(iter_json(folder)):
-        try:
-            with open(filename) as istream:
-                yield filename, json.load(istream)
+    "Iterate over the JSON documents in the folder, sorted by filename."
+    yield from load_docs(sorted(iter_json(folder)))
 
-        except json.decoder.JSONDecodeError:
-            raise RecordWithInvalidJSON(filename)
+
+def load_docs(filenames: List[str]) -> List[Tuple[str, dict]]:
+    "Read and parse the files in a thread pool so that their IO overlaps."
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_load_doc, filenames))
+
+
+def _load_doc(filename: str) -> Tuple[str, dict]:
+    try:
+        return filename, load_json(filename)
+
+    except json.decoder.JSONDecodeError:
+        raise RecordWithInvalidJSON(filename)
 
 
 def iter_json(base_dir: str) -> Iterator[str]:
-    for dirname, _, filenames in walk(base_dir):
-        for filename in filenames:
-            if filename.endswith(".json"):
-                yield path.join(dirname, filename)
+    "Find all JSON files under the folder, in no particular order."
+    # scandir reuses the directory listing to classify entries, avoiding a stat per file
+    stack = [base_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    yield entry.path
 
 
 def verify_md5(filename: str, expected_md5: str) -> None:
@@ -140,3 +497,11 @@ class RecordWithInvalidJSON(Exception):
 
 class ChecksumDoesNotMatch(Exception):
     pass
+
+
+class UnsupportedChecksumAlgorithm(Exception):
+    pass
+
+
+class RangeRequestFailed(Exception):
+    pass
@@ -19,6 +19,7 @@ def add_to_catalog(
     dataframe: Optional[pd.DataFrame] = None,
     upload: bool = False,
     public: bool = True,
+    hardlink: bool = False,
 ) -> None:
     """Add dataset with metadata to catalog, where the data is either a local file, or a dataframe in memory.
 
@@ -32,10 +33,12 @@ def add_to_catalog(
         dataframe (pd.DataFrame or None): Dataframe to upload (if filename is not given).
         upload (bool): True to upload data to Walden bucket.
         public (bool): True to make file public.
+        hardlink (bool): True to hardlink the file into the local cache instead of copying it. Only safe if the file
+            is not modified afterwards.
     """
     if (filename is not None) and (dataframe is None):
         # checksum happens in here, copy to cache happens here
-        dataset = Dataset.copy_and_create(str(filename), metadata)
+        dataset = Dataset.copy_and_create(str(filename), metadata, hardlink=hardlink)
 
         if upload:
             # add it to our DigitalOcean Space and set `owid_cache_url`
@@ -60,6 +63,7 @@ def add_to_catalog(
             metadata.md5 = files.checksum(temp_file)  # type: ignore
             # Run the function again, but now fetching the data from the temporary file instead of the dataframe.
             # This time the function will create the walden index file and upload to s3 (if upload is True).
-            add_to_catalog(metadata=metadata, filename=temp_file, upload=upload, public=public)
+            # The temporary file is deleted right after, so the cache can take it over without a copy.
+            add_to_catalog(metadata=metadata, filename=temp_file, upload=upload, public=public, hardlink=True)
     else:
         raise ValueError("Use either 'filename' or 'dataframe' argument, but not both.")
@@ -81,8 +81,8 @@ def s3_bucket_key(url: str) -> Tuple[str, str]:
     return bucket, key
 
 
-def download(s3_url: str, filename: str, expected_md5: Optional[str] = None, quiet: bool = False) -> None:
-    """Download the file at the S3 URL to the given local filename."""
+def download(s3_url: str, filename: str, expected_md5: Optional[str] = None, quiet: bool = False) -> Optional[str]:
+    """Download the file at the S3 URL to the given local filename. Return its md5 if it was checked."""
     client = connect()
 
     bucket, key = s3_bucket_key(s3_url)
@@ -93,14 +93,18 @@ def download(s3_url: str, filename: str, expected_md5: Optional[str] = None, qui
         logging.error(e)
         raise UploadError(e)
 
+    md5 = None
     if expected_md5:
-        if checksum(filename) != expected_md5:
+        md5 = checksum(filename)
+        if md5 != expected_md5:
             os.remove(filename)
             raise ChecksumDoesNotMatch(f"for file downloaded from {s3_url}")
 
     if not quiet:
         log("DOWNLOADED", f"{s3_url} -> {filename}")
 
+    return md5
+
 
 def connect():
     "Return a connection to Walden's DigitalOcean space."
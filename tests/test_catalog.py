@@ -6,12 +6,27 @@
 
 from pathlib import Path
 import datetime as dt
+import hashlib
 
 from jsonschema import Draft7Validator, validate, ValidationError
 import pytest
+import requests_mock
 
+from owid.walden import catalog, files
 from owid.walden.catalog import INDEX_DIR, Dataset, Catalog, load_schema, iter_docs
 
+# minimal metadata for a dataset that isn't in the catalog
+DATASET_KWARGS = dict(
+    name="test",
+    namespace="test",
+    short_name="test",
+    description="test",
+    source_name="test",
+    url="test",
+    file_extension="csv",
+    publication_year=2022,
+)
+
 
 def test_schema():
     "Make sure the schema itself is valid."
@@ -99,3 +114,133 @@ def test_default_dataset_version():
 
     ds = Dataset(version="2023-01-01", publication_date=dt.date(2022, 1, 1), **kwargs)
     assert ds.version == "2023-01-01"
+
+
+def test_dataset_dict_round_trip():
+    """from_dict ignores unknown keys and to_dict gives back every field."""
+    ds = Dataset.from_dict({**DATASET_KWARGS, "md5": "abc", "unknown_field": "ignored"})
+    assert ds.version == "2022"
+    assert Dataset.from_dict(ds.to_dict()) == ds
+    assert Dataset.from_json(ds.to_json()) == ds
+
+
+def test_dataset_paths_follow_field_changes():
+    """Cached paths are rebuilt when the fields they depend on change."""
+    ds = Dataset(**DATASET_KWARGS)
+    assert ds.local_path.endswith("test/2022/test.csv")
+
+    ds.version = "2023-01-01"
+    ds.file_extension = "zip"
+    assert ds.relative_base == "test/2023-01-01/test"
+    assert ds.index_path.endswith("test/2023-01-01/test.json")
+    assert ds.local_path.endswith("test/2023-01-01/test.zip")
+
+
+def test_add_to_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "CACHE_DIR", str(tmp_path / "cache"))
+    source = tmp_path / "data.csv"
+    source.write_text("a,b\n1,2\n")
+
+    ds = Dataset.copy_and_create(str(source), DATASET_KWARGS)
+    assert Path(ds.local_path).read_text() == "a,b\n1,2\n"
+
+    # rewriting the source in place leaves the cached copy alone
+    source.write_text("a,b\n3,4\n")
+    assert Path(ds.local_path).read_text() == "a,b\n1,2\n"
+
+    # adding it again replaces the cached copy
+    ds.add_to_cache(str(source))
+    assert Path(ds.local_path).read_text() == "a,b\n3,4\n"
+
+
+def test_add_to_cache_hardlink(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "CACHE_DIR", str(tmp_path / "cache"))
+    source = tmp_path / "data.csv"
+    source.write_text("a,b\n1,2\n")
+
+    ds = Dataset(**DATASET_KWARGS)
+    ds.add_to_cache(str(source), hardlink=True)
+    assert Path(ds.local_path).samefile(source)
+
+    # replacing it never writes through the old link
+    other = tmp_path / "other.csv"
+    other.write_text("a,b\n3,4\n")
+    ds.add_to_cache(str(other))
+    assert source.read_text() == "a,b\n1,2\n"
+    assert Path(ds.local_path).read_text() == "a,b\n3,4\n"
+
+
+def test_download_and_create_reuses_md5(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "CACHE_DIR", str(tmp_path))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the file should not be hashed a second time")
+
+    monkeypatch.setattr(files, "checksum", fail)
+
+    with requests_mock.Mocker() as mocker:
+        mocker.get("https://very/important/data.csv", content=b"a,b\n1,2\n")
+        ds = Dataset.download_and_create({**DATASET_KWARGS, "source_data_url": "https://very/important/data.csv"})
+
+    assert ds.md5 == hashlib.md5(b"a,b\n1,2\n").hexdigest()
+
+
+def test_dataset_from_dict_defaults():
+    """Optional fields take their defaults and required ones must be present."""
+    ds = Dataset.from_dict(DATASET_KWARGS)
+    assert ds.is_public is True
+    assert ds.md5 is None
+    assert ds.to_dict()["date_accessed"] == Dataset.date_accessed
+
+    doc = dict(DATASET_KWARGS)
+    del doc["name"]
+    with pytest.raises(KeyError):
+        Dataset.from_dict(doc)
+
+
+def test_dataset_from_dict_infer_missing():
+    """With infer_missing, absent fields are filled with None like dataclasses_json does."""
+    doc = dict(DATASET_KWARGS)
+    del doc["name"]
+    with pytest.warns(RuntimeWarning):
+        ds = Dataset.from_dict(doc, infer_missing=True)
+    assert ds.name is None
+    assert ds.short_name == "test"
+
+
+def test_iter_docs_refreshes_stale_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "INDEX_DIR", str(tmp_path))
+    (tmp_path / "a.json").write_text('{"name": "a"}')
+
+    assert [doc for _, doc in iter_docs()] == [{"name": "a"}]
+    assert (tmp_path / catalog.SNAPSHOT_FILE).exists()
+
+    (tmp_path / "a.json").write_text('{"name": "changed"}')
+
+    assert [doc for _, doc in iter_docs()] == [{"name": "changed"}]
+
+
+def test_iter_docs_ignores_broken_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "INDEX_DIR", str(tmp_path))
+    (tmp_path / "a.json").write_text('{"name": "a"}')
+    (tmp_path / catalog.SNAPSHOT_FILE).write_bytes(b"\x80\x04not a snapshot")
+
+    assert [doc for _, doc in iter_docs()] == [{"name": "a"}]
+
+    # the snapshot was rebuilt as compact JSON, with no temporary files left behind
+    snapshot = (tmp_path / catalog.SNAPSHOT_FILE).read_text()
+    assert "\n" not in snapshot
+    assert files.load_json(str(tmp_path / catalog.SNAPSHOT_FILE))["docs"] == [[f"{tmp_path}/a.json", {"name": "a"}]]
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([catalog.SNAPSHOT_FILE, "a.json"])
+
+
+def test_build_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "INDEX_DIR", str(tmp_path))
+    (tmp_path / "a.json").write_text('{"name": "\u00e9"}')
+
+    Catalog.build_snapshot()
+
+    # non-ASCII is kept as is, and the next load is served from the snapshot
+    assert "\u00e9" in (tmp_path / catalog.SNAPSHOT_FILE).read_text(encoding="utf-8")
+    monkeypatch.setattr(files, "load_docs", None)
+    assert [doc for _, doc in iter_docs()] == [{"name": "\u00e9"}]
@@ -3,8 +3,17 @@
 #  walden
 #
 
+import datetime as dt
+import gzip
+import json
+import os
 import tempfile
 import hashlib
+import http.server
+import threading
+import subprocess
+import sys
+import requests
 import requests_mock
 import pytest
 
@@ -40,7 +49,7 @@ def test_download_with_md5():
     with requests_mock.Mocker() as mocker, tempfile.NamedTemporaryFile() as destination:
         data_url = "https://very/important/data.csv"
         mocker.get(data_url, content=encoded)
-        files.download(data_url, destination.name, expected_md5=expected_md5)
+        assert files.download(data_url, destination.name, expected_md5=expected_md5) == expected_md5
 
         with open(destination.name) as _destination:
             content = "".join(_destination.readlines())
@@ -56,6 +65,20 @@ def test_download_with_wrong_md5_raises():
         with pytest.raises(files.ChecksumDoesNotMatch):
             files.download(data_url, destination.name, expected_md5="oh no.")
 
+        # the bad download is not left behind
+        assert not os.path.exists(destination.name + ".tmp")
+
+
+def test_download_decodes_gzip():
+    with requests_mock.Mocker() as mocker, tempfile.NamedTemporaryFile() as destination:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=gzip.compress(encoded), headers={"Content-Encoding": "gzip"})
+        files.download(data_url, destination.name, expected_md5=expected_md5)
+
+        with open(destination.name) as _destination:
+            content = "".join(_destination.readlines())
+            assert content == test_dataset
+
 
 def test_empty_checksum():
     with tempfile.NamedTemporaryFile() as tmp:
@@ -72,3 +95,240 @@ def test_known_checksum():
         md5 = files.checksum(tmp.name)
 
     assert md5 == hashlib.md5(s.encode("utf8")).hexdigest()
+
+
+def test_checksum_other_algorithm():
+    s = "Hello world o/\n"
+    with tempfile.NamedTemporaryFile() as tmp:
+        tmp.write(s.encode("utf8"))
+        tmp.flush()
+        digest = files.checksum(tmp.name, algorithm="sha256")
+
+    assert digest == hashlib.sha256(s.encode("utf8")).hexdigest()
+
+
+def test_checksum_unknown_algorithm_raises():
+    with tempfile.NamedTemporaryFile() as tmp:
+        with pytest.raises(files.UnsupportedChecksumAlgorithm):
+            files.checksum(tmp.name, algorithm="not-a-hash")
+
+
+def test_checksum_many():
+    with tempfile.NamedTemporaryFile() as a, tempfile.NamedTemporaryFile() as b:
+        a.write(b"first")
+        a.flush()
+        b.write(b"second")
+        b.flush()
+        digests = files.checksum_many([a.name, b.name])
+
+    assert digests == {
+        a.name: hashlib.md5(b"first").hexdigest(),
+        b.name: hashlib.md5(b"second").hexdigest(),
+    }
+
+
+def test_iter_docs_sorted():
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ["b", "a", "c"]:
+            with open(f"{folder}/{name}.json", "w") as ostream:
+                json.dump({"name": name}, ostream)
+
+        docs = list(files.iter_docs(folder))
+
+    assert [doc["name"] for _, doc in docs] == ["a", "b", "c"]
+
+
+def test_iter_docs_invalid_json_raises():
+    with tempfile.TemporaryDirectory() as folder:
+        with open(f"{folder}/broken.json", "w") as ostream:
+            ostream.write("{not json")
+
+        with pytest.raises(files.RecordWithInvalidJSON):
+            list(files.iter_docs(folder))
+
+
+def test_iter_docs_has_no_side_effects():
+    with tempfile.TemporaryDirectory() as folder:
+        with open(f"{folder}/a.json", "w") as ostream:
+            json.dump({"name": "a"}, ostream)
+
+        assert [doc for _, doc in files.iter_docs(folder)] == [{"name": "a"}]
+        assert os.listdir(folder) == ["a.json"]
+
+
+def _ranged_responder(versions):
+    """Respond like a server supporting ranges, moving on to the next version of the file after
+    each plain request."""
+    state = {"version": 0}
+
+    def respond(request, context):
+        etag, content = versions[state["version"]]
+        context.headers["Accept-Ranges"] = "bytes"
+        context.headers["ETag"] = etag
+
+        byte_range = request.headers.get("Range")
+        if not byte_range or request.headers.get("If-Range") != etag:
+            context.headers["Content-Length"] = str(len(content))
+            state["version"] = min(state["version"] + 1, len(versions) - 1)
+            return content
+
+        lo, hi = map(int, byte_range[len("bytes=") :].split("-"))
+        context.status_code = 206
+        return content[lo : hi + 1]
+
+    return respond
+
+
+def test_download_in_ranges(monkeypatch):
+    monkeypatch.setattr(files, "RANGED_DOWNLOAD_MIN_BYTES", 10)
+
+    with requests_mock.Mocker() as mocker, tempfile.NamedTemporaryFile() as destination:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=_ranged_responder([('"v1"', encoded)]))
+        files.download(data_url, destination.name, expected_md5=expected_md5)
+
+        with open(destination.name) as _destination:
+            content = "".join(_destination.readlines())
+            assert content == test_dataset
+
+        # one request for the headers, then one per range, all tied to the same version
+        assert mocker.call_count == 1 + files.RANGED_DOWNLOAD_CONNECTIONS
+        assert all(r.headers["If-Range"] == '"v1"' for r in mocker.request_history[1:])
+
+
+def test_download_in_ranges_falls_back_when_file_changes(monkeypatch):
+    monkeypatch.setattr(files, "RANGED_DOWNLOAD_MIN_BYTES", 10)
+    updated = encoded.replace(b"42", b"43")
+
+    with requests_mock.Mocker() as mocker, tempfile.NamedTemporaryFile() as destination:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=_ranged_responder([('"v1"', encoded), ('"v2"', updated)]))
+        md5 = files.download(data_url, destination.name)
+
+        # we get the new version in full, not a mix of both
+        with open(destination.name, "rb") as _destination:
+            assert _destination.read() == updated
+        assert md5 == hashlib.md5(updated).hexdigest()
+
+
+def test_download_many():
+    with requests_mock.Mocker() as mocker, tempfile.TemporaryDirectory() as folder:
+        pairs = []
+        for name in ["a", "b", "c"]:
+            data_url = f"https://very/important/{name}.csv"
+            mocker.get(data_url, content=name.encode("utf-8"))
+            pairs.append((data_url, f"{folder}/{name}.csv"))
+
+        md5s = files.download_many(pairs, quiet=True)
+        assert md5s == [hashlib.md5(name.encode("utf-8")).hexdigest() for name in ["a", "b", "c"]]
+
+        for name in ["a", "b", "c"]:
+            with open(f"{folder}/{name}.csv") as _destination:
+                assert _destination.read() == name
+
+
+def test_download_with_content_length():
+    with requests_mock.Mocker() as mocker, tempfile.NamedTemporaryFile() as destination:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=encoded, headers={"Content-Length": str(len(encoded))})
+        files.download(data_url, destination.name, expected_md5=expected_md5)
+
+        with open(destination.name, "rb") as _destination:
+            assert _destination.read() == encoded
+
+
+def test_write_json_matches_index_format():
+    doc = {
+        "name": "Café data",
+        "publication_date": dt.date(2022, 1, 1),
+        "date_accessed": dt.datetime(2022, 1, 1, 12, 30),
+        "publication_year": 2022,
+        "values": [1, None, True],
+        "empty": {},
+    }
+    floats = {"values": [2.5, 1e16, 1e-7, float("nan"), float("inf")]}
+    with tempfile.TemporaryDirectory() as folder:
+        for obj in [doc, {**doc, "name": "ascii"}, floats]:
+            files.write_json(obj, f"{folder}/doc.json")
+
+            with open(f"{folder}/doc.json") as istream:
+                assert istream.read() == json.dumps(obj, indent=2, default=str) + "\n"
+
+
+def test_stream_to_file_small_gzip_chunks():
+    # small compressed chunks can decode to nothing halfway through the body
+    data = b"some,data,wow\n" * 10000
+    with requests_mock.Mocker() as mocker, tempfile.TemporaryFile() as destination:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=gzip.compress(data), headers={"Content-Encoding": "gzip"})
+        with requests.get(data_url, stream=True) as r:
+            md5 = files._stream_to_file(r, destination, chunk_size=16)
+
+        destination.seek(0)
+        assert destination.read() == data
+        assert md5 == hashlib.md5(data).hexdigest()
+
+
+def test_download_chunk_size_from_env(monkeypatch):
+    monkeypatch.delenv("WALDEN_DL_CHUNK", raising=False)
+    assert files._download_chunk_size() == 2**18
+
+    monkeypatch.setenv("WALDEN_DL_CHUNK", str(2**20))
+    assert files._download_chunk_size() == 2**20
+
+    # tiny values are raised to the minimum
+    monkeypatch.setenv("WALDEN_DL_CHUNK", "16")
+    assert files._download_chunk_size() == files.MIN_DOWNLOAD_CHUNK_SIZE
+
+    for value in ["0", "-1", "lots"]:
+        monkeypatch.setenv("WALDEN_DL_CHUNK", value)
+        with pytest.raises(ValueError):
+            files._download_chunk_size()
+
+
+def test_bad_download_chunk_size_fails_on_download_not_import(monkeypatch):
+    monkeypatch.setenv("WALDEN_DL_CHUNK", "1MB")
+    subprocess.run([sys.executable, "-c", "import owid.walden"], check=True)
+
+    with requests_mock.Mocker() as mocker, tempfile.TemporaryDirectory() as folder:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=encoded)
+        with pytest.raises(ValueError):
+            files.download(data_url, f"{folder}/data.csv")
+
+        # nothing is left behind
+        assert os.listdir(folder) == []
+
+
+def test_download_raises_requests_errors():
+    # callers catch requests' exceptions, not urllib3's
+    with requests_mock.Mocker() as mocker, tempfile.TemporaryDirectory() as folder:
+        data_url = "https://very/important/data.csv"
+        mocker.get(data_url, content=b"not gzip at all", headers={"Content-Encoding": "gzip"})
+        with pytest.raises(requests.exceptions.ContentDecodingError):
+            files.download(data_url, f"{folder}/data.csv")
+
+
+def test_download_persistent_server_error_raises_http_error(monkeypatch):
+    # requests_mock bypasses urllib3's retries, so talk to a real (local) server
+    monkeypatch.setattr("urllib3.util.retry.time.sleep", lambda _: None)
+
+    class Unavailable(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Unavailable)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            data_url = f"http://127.0.0.1:{server.server_port}/data.csv"
+            with pytest.raises(requests.exceptions.HTTPError):
+                files.download(data_url, f"{folder}/data.csv")
+    finally:
+        server.shutdown()
+        server.server_close()